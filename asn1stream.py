@@ -3,6 +3,9 @@ ASN1 handling over streams in a fixed memory space.
 """
 from __future__ import absolute_import, unicode_literals
 
+import binascii
+import re
+
 from enum import IntEnum
 
 
@@ -360,3 +363,326 @@ class StreamingASN1Decoder(object):
         result = [result[0] // 40, result[0] % 40] + result[1:]
         result = list(map(str, result))
         return str('.'.join(result))
+
+
+class StreamingBase64Decoder(object):
+    """
+    Transfer decoder for base64 encoded ASN.1 data.
+
+    It is designed to be placed in front of a `StreamingASN1Decoder`.
+    The text input is provided in chunks and the decoded bytes are passed
+    to the ASN.1 decoder as soon as a full base64 quantum is available.
+
+    Understands plain base64 with line breaks, PEM armour and MIME
+    messages. For multipart MIME messages, only the PKCS7 parts are
+    decoded.
+    """
+
+    # Maximum size of a header or armour line.
+    MAX_LINE_SIZE = 998
+    # Maximum number of input bytes handled at once, so that the decoded
+    # data is passed to the ASN.1 decoder in small pieces.
+    MAX_PIECE_SIZE = 4 * 1024
+
+    _START = 'start'
+    _HEADERS = 'headers'
+    _BODY = 'body'
+    _SKIP = 'skip'
+    _DONE = 'done'
+
+    _BOUNDARY = re.compile(br'boundary="?([^";]+)"?', re.IGNORECASE)
+
+    def __init__(self, decoder):  # type: (StreamingASN1Decoder) -> None
+        self._decoder = decoder
+        self._state = self._START
+        # How the current line is handled. `None` at the start of a line.
+        self._line_mode = None
+        # Partial header or armour line.
+        self._line = b''
+        # Base64 characters not yet forming a full quantum.
+        self._quantum = b''
+        # Whether the padding at the end of the base64 data was received.
+        self._padded = False
+        # Input not yet handled, as the ASN.1 decoder was full.
+        self._input = b''
+        # Decoded data not yet accepted by the ASN.1 decoder.
+        self._decoded = b''
+        # Headers of the current MIME part.
+        self._headers = []
+        # Boundaries of the nested multipart MIME messages.
+        self._boundaries = []
+        self._multipart = False
+        self._pkcs7_found = False
+
+    def dataReceived(self, data):
+        """
+        Called when we got more encoded data.
+
+        Will raise ASN1SyntaxError when data can't be decoded.
+
+        Will raise ASN1TooMuch when the ASN.1 decoder can't receive more
+        data. The rest of the data is kept. Consume the decoded data and
+        call resume() to continue, without sending the same data again.
+        """
+        self._input += data
+        self.resume()
+
+    def resume(self):
+        """
+        Continue decoding the data kept after ASN1TooMuch was raised.
+        """
+        data, self._input = self._input, b''
+        start = 0
+        try:
+            while True:
+                if self._decoded:
+                    self._decoder.dataReceived(self._decoded)
+                    self._decoded = b''
+
+                if start >= len(data):
+                    return
+
+                start = self._handlePiece(data, start)
+        except ASN1TooMuch:
+            self._input = data[start:]
+            raise
+
+    def close(self):
+        """
+        Called when all the data was received.
+
+        Raises ASN1SyntaxError if base64 data was truncated or when a
+        multipart message has no PKCS7 part.
+        """
+        self.resume()
+        if self._line_mode in ('buffer', 'boundary'):
+            self._lineDone()
+        self._partDone()
+        self._state = self._DONE
+        self.resume()
+
+        if self._multipart and not self._pkcs7_found:
+            raise ASN1SyntaxError('No PKCS7 part in multipart message.')
+
+    def _handlePiece(self, data, start):
+        """
+        Handle the input starting at `start` up to the end of the line,
+        limited to MAX_PIECE_SIZE.
+
+        Return where the next piece starts.
+        """
+        if self._line_mode is None:
+            self._line_mode = self._getLineMode(data[start:start + 1])
+
+        end = data.find(b'\n', start, start + self.MAX_PIECE_SIZE)
+        if end == -1:
+            line = data[start:start + self.MAX_PIECE_SIZE]
+            next_start = start + len(line)
+        else:
+            line = data[start:end]
+            next_start = end + 1
+
+        if self._line_mode == 'data':
+            self._decode(line)
+        elif self._line_mode == 'buffer':
+            self._line += line
+            if len(self._line) > self.MAX_LINE_SIZE:
+                self._lineTooLong()
+        elif self._line_mode == 'boundary':
+            # Keep just enough to match a boundary and its closing marker.
+            size = max(len(boundary) for boundary in self._boundaries) + 4
+            self._line = (self._line + line)[:size]
+
+        if end != -1:
+            self._lineDone()
+
+        return next_start
+
+    def _getLineMode(self, first):
+        """
+        Return how a line starting with the `first` byte is handled.
+        """
+        if self._state in (self._START, self._HEADERS):
+            return 'buffer'
+
+        if self._state == self._DONE:
+            return 'skip'
+
+        if self._state == self._SKIP:
+            if first == b'-' and self._boundaries:
+                return 'boundary'
+            return 'skip'
+
+        if first == b'-':
+            # Armour or MIME boundary.
+            return 'buffer'
+
+        return 'data'
+
+    def _lineTooLong(self):
+        """
+        Called when a buffered line is larger than MAX_LINE_SIZE.
+
+        A long line at the start is base64 data without line breaks.
+        """
+        if self._state != self._START or b':' in self._line:
+            raise ASN1SyntaxError('Line too long.')
+
+        self._state = self._BODY
+        self._line_mode = 'data'
+        line, self._line = self._line, b''
+        self._decode(line)
+
+    def _lineDone(self):
+        """
+        Called at the end of each line.
+        """
+        mode = self._line_mode
+        self._line_mode = None
+        if mode not in ('buffer', 'boundary'):
+            return
+
+        line, self._line = self._line.rstrip(b'\r'), b''
+        if mode == 'boundary':
+            self._boundaryReceived(line)
+        else:
+            self._lineReceived(line)
+
+    def _lineReceived(self, line):
+        """
+        Called for a full header or armour line.
+        """
+        if self._state == self._START:
+            if line.startswith(b'-----BEGIN '):
+                self._state = self._BODY
+            elif b':' in line:
+                self._state = self._HEADERS
+                self._headers.append(line)
+            elif line.strip():
+                self._state = self._BODY
+                self._decode(line)
+            return
+
+        if self._state == self._HEADERS:
+            if not line.strip():
+                self._headersDone()
+            elif line[:1] in (b' ', b'\t') and self._headers:
+                # Folded header.
+                self._headers[-1] += line
+            else:
+                self._headers.append(line)
+            return
+
+        if self._boundaryReceived(line):
+            return
+
+        if self._state != self._BODY:
+            return
+
+        if line.startswith(b'-----END '):
+            self._partDone()
+            self._state = self._DONE
+        elif not line.startswith(b'-----BEGIN '):
+            raise ASN1SyntaxError('Invalid base64 line.')
+
+    def _boundaryReceived(self, line):
+        """
+        Called for a line which might be a MIME boundary.
+
+        Return `True` when the line is a boundary.
+        """
+        for index in range(len(self._boundaries) - 1, -1, -1):
+            delimiter = b'--' + self._boundaries[index]
+            if not line.startswith(delimiter):
+                continue
+
+            self._partDone()
+            # Close the nested messages not explicitly closed.
+            del self._boundaries[index + 1:]
+            if line[len(delimiter):len(delimiter) + 2] != b'--':
+                self._state = self._HEADERS
+                return True
+
+            # Ignore the epilogue, up to the next outer boundary.
+            self._boundaries.pop()
+            if self._boundaries:
+                self._state = self._SKIP
+            else:
+                self._state = self._DONE
+            return True
+
+        return False
+
+    def _headersDone(self):
+        """
+        Called at the end of the headers of a MIME part.
+        """
+        headers = {}
+        for header in self._headers:
+            name, _, value = header.partition(b':')
+            headers[name.strip().lower()] = value.strip()
+        self._headers = []
+
+        content_type = headers.get(b'content-type', b'').lower()
+        encoding = headers.get(b'content-transfer-encoding', b'base64')
+
+        if content_type.startswith(b'multipart/'):
+            match = self._BOUNDARY.search(headers[b'content-type'])
+            if not match:
+                raise ASN1SyntaxError('Multipart without boundary.')
+            self._boundaries.append(match.group(1))
+            self._multipart = True
+            # Ignore the preamble.
+            self._state = self._SKIP
+            return
+
+        if self._boundaries and b'pkcs7' not in content_type:
+            # Not the ASN.1 part of the message.
+            self._state = self._SKIP
+            return
+
+        if encoding.lower() != b'base64':
+            raise ASN1Error('Only base64 transfer encoding is supported.')
+
+        self._pkcs7_found = True
+        self._state = self._BODY
+
+    def _partDone(self):
+        """
+        Called at the end of the encoded data.
+        """
+        if self._quantum:
+            raise ASN1SyntaxError('Truncated base64 data.')
+        self._padded = False
+
+    def _decode(self, text):
+        """
+        Decode the full quanta from `text` and pass them to the decoder.
+        """
+        text = self._quantum + text.translate(None, b' \t\r\n')
+        if not text:
+            return
+
+        if self._padded:
+            raise ASN1SyntaxError('Data after base64 padding.')
+
+        padding = text.find(b'=')
+        if padding != -1:
+            # Padding is only allowed at the end of the last quantum.
+            end = padding - padding % 4 + 4
+            if len(text) > end or text[padding:end].strip(b'='):
+                raise ASN1SyntaxError('Data after base64 padding.')
+            self._padded = len(text) == end
+
+        size = len(text) - len(text) % 4
+        self._quantum = text[size:]
+        if not size:
+            return
+
+        try:
+            data = binascii.a2b_base64(text[:size])
+        except binascii.Error:
+            raise ASN1SyntaxError('Invalid base64 data.')
+
+        # Passed to the ASN.1 decoder before handling the next piece.
+        self._decoded += data
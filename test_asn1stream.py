@@ -4,6 +4,8 @@ Tests for ASN1 streaming implementation.
 openssl asn1parse -inform DER -i -in dump.asn1
 """
 from __future__ import unicode_literals
+import base64
+import binascii
 import unittest
 
 from asn1crypto.cms import RecipientInfos
@@ -196,3 +198,233 @@ class TestStreamingASN1Decoder(unittest.TestCase):
         self.assertEqual(asn1.Numbers.Set, tag.number)
         # content_type -> data OID
         self.assertEqual('1.2.840.113549.1.7.1', sut.read(tag))
+
+
+def encodeLines(data):
+    """
+    Return `data` encoded as base64 lines of 76 characters.
+    """
+    return b''.join(
+        binascii.b2a_base64(data[i:i + 57]) for i in range(0, len(data), 57))
+
+
+class DummyDecoder(object):
+    """
+    Keeps all the data received from a transfer decoder.
+    """
+
+    def __init__(self):
+        self.data = b''
+
+    def dataReceived(self, data):
+        self.data += data
+
+
+class TestStreamingBase64Decoder(unittest.TestCase):
+    """
+    Tests for StreamingBase64Decoder.
+    """
+
+    def decode(self, encoded, chunk_size=1):
+        """
+        Decode `encoded` in chunks and return the decoded data.
+        """
+        decoder = DummyDecoder()
+        sut = asn1.StreamingBase64Decoder(decoder)
+
+        for i in range(0, len(encoded), chunk_size):
+            sut.dataReceived(encoded[i:i + chunk_size])
+        sut.close()
+
+        return decoder.data
+
+    def test_base64(self):
+        """
+        Partial quanta are kept across chunks.
+        """
+        encoded = encodeLines(TEST_DATA)
+
+        self.assertEqual(TEST_DATA, self.decode(encoded))
+        self.assertEqual(TEST_DATA, self.decode(encoded, chunk_size=7))
+
+    def test_base64_no_line_breaks(self):
+        """
+        Data without line breaks is decoded without buffering the line.
+        """
+        encoded = base64.b64encode(TEST_DATA)
+
+        self.assertEqual(TEST_DATA, self.decode(encoded, chunk_size=100))
+
+    def test_pem(self):
+        """
+        PEM armour is ignored.
+        """
+        encoded = (
+            b'-----BEGIN PKCS7-----\r\n' +
+            encodeLines(TEST_DATA).replace(b'\n', b'\r\n') +
+            b'-----END PKCS7-----\r\n'
+            )
+
+        self.assertEqual(TEST_DATA, self.decode(encoded))
+
+    def test_mime(self):
+        """
+        MIME headers are ignored.
+        """
+        encoded = (
+            b'Content-Type: application/pkcs7-mime;\r\n'
+            b' smime-type=enveloped-data\r\n'
+            b'Content-Transfer-Encoding: base64\r\n'
+            b'\r\n' +
+            encodeLines(TEST_DATA)
+            )
+
+        self.assertEqual(TEST_DATA, self.decode(encoded))
+
+    def test_mime_multipart(self):
+        """
+        Only the PKCS7 part of a multipart message is decoded.
+        """
+        encoded = (
+            b'Content-Type: multipart/signed; boundary="BOUNDARY"\n'
+            b'\n'
+            b'Preamble\n'
+            b'--BOUNDARY\n'
+            b'Content-Type: text/plain\n'
+            b'\n'
+            b'Some: text\n'
+            b'--BOUNDARY\n'
+            b'Content-Type: application/pkcs7-signature\n'
+            b'Content-Transfer-Encoding: base64\n'
+            b'\n' +
+            encodeLines(TEST_DATA) +
+            b'--BOUNDARY--\n'
+            b'Epilogue\n'
+            )
+
+        self.assertEqual(TEST_DATA, self.decode(encoded))
+
+    def test_truncated(self):
+        """
+        An error is raised when base64 data ends with a partial quantum.
+        """
+        encoded = base64.b64encode(TEST_DATA)[:-3]
+
+        self.assertRaises(
+            asn1.ASN1SyntaxError,
+            self.decode, encoded
+            )
+
+    def test_data_after_padding(self):
+        """
+        An error is raised when base64 data continues after the padding,
+        regardless of how the data is chunked.
+        """
+        for encoded in [b'QQ==QUJD', b'QQ==\nQUJD\n', b'QQ=A']:
+            for chunk_size in [1, 3, 100]:
+                self.assertRaises(
+                    asn1.ASN1SyntaxError,
+                    self.decode, encoded, chunk_size
+                    )
+
+        self.assertEqual(b'A', self.decode(b'QQ==\n\n'))
+
+    def test_too_much(self):
+        """
+        When the ASN.1 decoder is full, the rest of the data is kept
+        and decoding continues after the decoded data is consumed.
+        """
+        data = TEST_DATA * 350
+        self.assertGreater(
+            len(data), asn1.StreamingASN1Decoder.MAX_BUFFER_SIZE)
+
+        for encoded in [encodeLines(data), base64.b64encode(data)]:
+            decoder = asn1.StreamingASN1Decoder()
+            sut = asn1.StreamingBase64Decoder(decoder)
+            result = b''
+            full = 0
+
+            action = sut.dataReceived
+            args = (encoded,)
+            while True:
+                try:
+                    action(*args)
+                    break
+                except asn1.ASN1TooMuch:
+                    full += 1
+                    # Consume all the decoded data.
+                    result += decoder._buffer
+                    decoder._buffer = b''
+                    action = sut.resume
+                    args = ()
+            sut.close()
+            result += decoder._buffer
+
+            self.assertGreater(full, 0)
+            self.assertEqual(data, result)
+
+    def test_mime_multipart_binary(self):
+        """
+        Binary parts which are skipped can contain any data.
+        """
+        encoded = (
+            b'Content-Type: multipart/signed; boundary="BOUNDARY"\n'
+            b'\n'
+            b'--BOUNDARY\n'
+            b'Content-Type: application/octet-stream\n'
+            b'Content-Transfer-Encoding: binary\n'
+            b'\n'
+            b'\x00-\n-' + b'-' * 5000 + b'\n--BOUNDAR\n--\xff\n'
+            b'--BOUNDARY\n'
+            b'Content-Type: application/pkcs7-signature\n'
+            b'\n' +
+            encodeLines(TEST_DATA) +
+            b'--BOUNDARY--\n'
+            )
+
+        self.assertEqual(TEST_DATA, self.decode(encoded))
+        self.assertEqual(TEST_DATA, self.decode(encoded, chunk_size=100))
+
+    def test_mime_multipart_nested(self):
+        """
+        The PKCS7 part following a nested multipart part is decoded.
+        """
+        encoded = (
+            b'Content-Type: multipart/signed; boundary="OUTER"\n'
+            b'\n'
+            b'--OUTER\n'
+            b'Content-Type: multipart/mixed; boundary="INNER"\n'
+            b'\n'
+            b'--INNER\n'
+            b'Content-Type: text/plain\n'
+            b'\n'
+            b'Some: text\n'
+            b'--INNER--\n'
+            b'Inner epilogue\n'
+            b'--OUTER\n'
+            b'Content-Type: application/pkcs7-signature\n'
+            b'\n' +
+            encodeLines(TEST_DATA) +
+            b'--OUTER--\n'
+            )
+
+        self.assertEqual(TEST_DATA, self.decode(encoded))
+
+    def test_mime_multipart_no_pkcs7(self):
+        """
+        An error is raised when a multipart message has no PKCS7 part.
+        """
+        encoded = (
+            b'Content-Type: multipart/mixed; boundary="BOUNDARY"\n'
+            b'\n'
+            b'--BOUNDARY\n'
+            b'Content-Type: text/plain\n'
+            b'\n'
+            b'Some: text\n'
+            b'--BOUNDARY--\n'
+            )
+
+        self.assertRaises(
+            asn1.ASN1SyntaxError,
+            self.decode, encoded
+            )
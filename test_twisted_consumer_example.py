@@ -0,0 +1,593 @@
+"""
+Tests for the Twisted consumers of ASN1 streams.
+"""
+from __future__ import unicode_literals
+import errno
+import os
+import shutil
+import tempfile
+import unittest
+
+from twisted.internet.task import Clock
+from twisted.internet.interfaces import IConsumer, IPushProducer
+from twisted.python import log
+from twisted.python.failure import Failure
+from zope.interface import implementer
+
+import twisted_consumer_example as example
+
+
+@implementer(IPushProducer)
+class DummyProducer(object):
+    """
+    Keeps the calls made to a push producer.
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    def pauseProducing(self):
+        self.calls.append('pause')
+
+    def resumeProducing(self):
+        self.calls.append('resume')
+
+    def stopProducing(self):
+        self.calls.append('stop')
+
+
+@implementer(IConsumer)
+class DummySink(object):
+    """
+    Keeps all the chunks written to a consumer.
+    """
+
+    def __init__(self):
+        self.producer = None
+        self.chunks = []
+        self.unregistered = False
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.unregistered = True
+
+    def write(self, data):
+        self.chunks.append(data)
+
+
+class TestASN1StreamTee(unittest.TestCase):
+    """
+    Tests for ASN1StreamTee.
+    """
+
+    def setUp(self):
+        self.upstream = DummyProducer()
+        self.first = DummySink()
+        self.second = DummySink()
+        self.sut = example.ASN1StreamTee()
+        self.sut.addSink(self.first)
+        self.sut.addSink(self.second)
+
+    def test_chunkReceived(self):
+        """
+        The same chunk object is written to all the sinks.
+        """
+        chunk = b'some data'
+
+        self.sut._chunkReceived(chunk)
+
+        self.assertIs(chunk, self.first.chunks[0])
+        self.assertIs(chunk, self.second.chunks[0])
+
+    def test_unregisterProducer(self):
+        """
+        All the sinks are unregistered at the end of the stream.
+        """
+        self.sut.registerProducer(self.upstream)
+
+        self.sut.unregisterProducer()
+
+        self.assertTrue(self.first.unregistered)
+        self.assertTrue(self.second.unregistered)
+
+    def test_backpressure(self):
+        """
+        Upstream is paused by the first saturated sink and is resumed
+        only after all the sinks can receive more data.
+        """
+        self.sut.registerProducer(self.upstream)
+
+        self.first.producer.pauseProducing()
+        self.second.producer.pauseProducing()
+        self.assertEqual(['pause'], self.upstream.calls)
+
+        self.first.producer.resumeProducing()
+        self.assertEqual(['pause'], self.upstream.calls)
+
+        self.second.producer.resumeProducing()
+        self.assertEqual(['pause', 'resume'], self.upstream.calls)
+
+    def test_paused_before_registerProducer(self):
+        """
+        A sink saturated before upstream is registered pauses upstream
+        as soon as it is registered.
+        """
+        self.first.producer.pauseProducing()
+
+        self.sut.registerProducer(self.upstream)
+
+        self.assertEqual(['pause'], self.upstream.calls)
+
+    def test_sinkStopped(self):
+        """
+        Upstream is stopped once the last sink is stopped, and the stopped
+        sinks no longer receive data.
+        """
+        self.sut.registerProducer(self.upstream)
+
+        self.first.producer.stopProducing()
+        self.sut._chunkReceived(b'data')
+        self.assertEqual([], self.upstream.calls)
+        self.assertEqual([], self.first.chunks)
+        self.assertEqual([b'data'], self.second.chunks)
+
+        self.second.producer.stopProducing()
+        self.assertEqual(['stop'], self.upstream.calls)
+
+    def test_sinkStopped_while_paused(self):
+        """
+        A saturated sink which is stopped no longer keeps upstream paused.
+        """
+        self.sut.registerProducer(self.upstream)
+        self.first.producer.pauseProducing()
+
+        self.first.producer.stopProducing()
+
+        self.assertEqual(['pause', 'resume'], self.upstream.calls)
+
+    def test_sinkStopped_during_write(self):
+        """
+        A sink stopped while a chunk is written to the previous sinks
+        no longer receives that chunk.
+        """
+        def stopSecond(data):
+            self.first.chunks.append(data)
+            self.second.producer.stopProducing()
+        self.first.write = stopSecond
+
+        self.sut._chunkReceived(b'data')
+
+        self.assertEqual([b'data'], self.first.chunks)
+        self.assertEqual([], self.second.chunks)
+
+    def test_write_failed(self):
+        """
+        A sink failing to write is logged and dropped, while the other
+        sinks still receive the chunks.
+        """
+        self.sut.registerProducer(self.upstream)
+        errors = []
+        log.addObserver(errors.append)
+        self.addCleanup(log.removeObserver, errors.append)
+
+        def fail(data):
+            raise IOError('Sink failure.')
+        self.first.write = fail
+
+        self.sut._chunkReceived(b'first')
+        self.sut._chunkReceived(b'second')
+
+        self.assertEqual([b'first', b'second'], self.second.chunks)
+        self.assertEqual(1, len([e for e in errors if e.get('isError')]))
+        self.assertEqual([], self.upstream.calls)
+
+        self.second.write = fail
+        self.sut._chunkReceived(b'third')
+
+        self.assertEqual(['stop'], self.upstream.calls)
+
+
+class TestASN1FileSink(unittest.TestCase):
+    """
+    Tests for ASN1FileSink.
+    """
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'payload')
+        self.clock = Clock()
+        self.sut = example.ASN1FileSink(
+            self.path, batch_size=10, max_latency=1, clock=self.clock)
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.addCleanup(self.sut.close)
+        # Buffers passed to each writev call.
+        self.batches = []
+        self._writev = self.sut._writev
+        self.sut._writev = self.recordWritev
+
+    def recordWritev(self, buffers):
+        """
+        Keep the buffers of each write.
+        """
+        self.batches.append([bytes(buffer) for buffer in buffers])
+        return self._writev(buffers)
+
+    def getContent(self):
+        """
+        Return the data currently written to the file.
+        """
+        with open(self.path, 'rb') as stream:
+            return stream.read()
+
+    def test_batch(self):
+        """
+        Chunks are written in a single call once batch_size bytes are
+        pending.
+        """
+        self.sut.write(b'1234')
+        self.sut.write(b'5678')
+        self.assertEqual(b'', self.getContent())
+
+        self.sut.write(b'90')
+
+        self.assertEqual([[b'1234', b'5678', b'90']], self.batches)
+        self.assertEqual(b'1234567890', self.getContent())
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def test_max_iov(self):
+        """
+        A batch with more than MAX_IOV chunks is split in multiple calls.
+        """
+        self.sut.MAX_IOV = 2
+
+        for chunk in [b'12', b'34', b'56', b'78', b'90']:
+            self.sut.write(chunk)
+
+        self.assertEqual(
+            [[b'12', b'34'], [b'56', b'78'], [b'90']], self.batches)
+        self.assertEqual(b'1234567890', self.getContent())
+
+    def test_partial_write(self):
+        """
+        After a partial write, the rest of the data is written starting
+        with the partially written chunk.
+        """
+        def writeSome(buffers):
+            self.batches.append([bytes(buffer) for buffer in buffers])
+            data = b''.join(bytes(buffer) for buffer in buffers)
+            return os.write(self.sut._fd, data[:3])
+        self.sut._writev = writeSome
+
+        self.sut.write(b'1234')
+        self.sut.write(b'567890')
+
+        self.assertEqual(
+            [
+                [b'1234', b'567890'],
+                [b'4', b'567890'],
+                [b'7890'],
+                [b'0'],
+                ],
+            self.batches)
+        self.assertEqual(b'1234567890', self.getContent())
+
+    def test_writev_fallback(self):
+        """
+        When writev is not available, the buffers are joined, including
+        the memoryview objects.
+        """
+        writev = getattr(os, 'writev', None)
+        if writev:
+            del os.writev
+            self.addCleanup(setattr, os, 'writev', writev)
+
+        result = self._writev([b'123', memoryview(b'456')])
+
+        self.assertEqual(6, result)
+        self.assertEqual(b'123456', self.getContent())
+
+    def test_max_latency(self):
+        """
+        Pending chunks are written after max_latency seconds since the
+        first pending chunk.
+        """
+        self.sut.write(b'123')
+        self.clock.advance(0.5)
+        self.sut.write(b'456')
+        self.assertEqual(b'', self.getContent())
+
+        self.clock.advance(0.5)
+
+        self.assertEqual([[b'123', b'456']], self.batches)
+        self.assertEqual(b'123456', self.getContent())
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def test_unregisterProducer(self):
+        """
+        At the end of the message, the pending data is written and the
+        preallocated space which was not used is released.
+        """
+        self.sut.preallocate(1000)
+        self.sut.write(b'123')
+
+        self.sut.unregisterProducer()
+
+        self.assertIsNone(self.sut._fd)
+        self.assertEqual([], self.clock.getDelayedCalls())
+        self.assertEqual(b'123', self.getContent())
+
+    def test_close(self):
+        """
+        When the message is aborted, pending data is dropped and the
+        file is closed.
+        """
+        self.sut.write(b'123')
+
+        self.sut.close()
+        self.sut.write(b'4567890')
+        self.sut.unregisterProducer()
+
+        self.assertIsNone(self.sut._fd)
+        self.assertEqual([], self.clock.getDelayedCalls())
+        self.assertEqual([], self.batches)
+        self.assertEqual(b'', self.getContent())
+
+    def test_write_failed(self):
+        """
+        After a failed write, the file is closed and the error is raised
+        for the next writes and at the end of the message.
+        """
+        def fail(buffers):
+            raise OSError(errno.EIO, 'Write failed.')
+        self.sut._writev = fail
+        self.sut.write(b'AAAA')
+
+        self.assertRaises(OSError, self.clock.advance, 1)
+
+        self.assertIsNone(self.sut._fd)
+        self.sut._writev = self.recordWritev
+        with self.assertRaises(OSError) as context:
+            self.sut.write(b'BBBB')
+        self.assertEqual(errno.EIO, context.exception.errno)
+        self.assertRaises(OSError, self.sut.unregisterProducer)
+        self.assertEqual([], self.batches)
+        self.assertEqual(b'', self.getContent())
+
+
+class DummyReactor(object):
+    """
+    Reactor for which the calls from threads are executed right away.
+    """
+
+    def callFromThread(self, function, *args, **kwargs):
+        function(*args, **kwargs)
+
+
+class DummyThreadPool(object):
+    """
+    Thread pool for which the calls are executed on request.
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    def callInThreadWithCallback(self, onResult, function, *args, **kwargs):
+        self.calls.append((onResult, function, args, kwargs))
+
+    def run(self, index=0):
+        """
+        Execute a single queued call.
+        """
+        onResult, function, args, kwargs = self.calls.pop(index)
+        try:
+            result = function(*args, **kwargs)
+        except Exception:
+            onResult(False, Failure())
+        else:
+            onResult(True, result)
+
+    def runAll(self, index=0):
+        """
+        Execute the queued calls until there is nothing left to run.
+        """
+        while self.calls:
+            self.run(index)
+
+
+def checkChunk(data):
+    """
+    Stage failing for bad data.
+    """
+    if data == b'BAD':
+        raise ValueError('Bad chunk.')
+    return data
+
+
+class DummyPipelineConsumer(example.ASN1PipelineConsumer):
+    """
+    Keeps the chunks going out of the pipeline.
+    """
+    _stages = [lambda data: data.upper(), checkChunk]
+
+    def __init__(self, reactor, threadpool):
+        super(DummyPipelineConsumer, self).__init__(reactor, threadpool)
+        self.processed = []
+        self.failures = []
+
+    def _chunkProcessed(self, data):
+        if data == b'FAIL':
+            raise ValueError('Bad result.')
+        self.processed.append(data)
+
+    def _pipelineFailed(self, failure):
+        self.failures.append(failure)
+        super(DummyPipelineConsumer, self)._pipelineFailed(failure)
+
+    def _finalize(self):
+        return b'end'
+
+
+class TestASN1PipelineConsumer(unittest.TestCase):
+    """
+    Tests for ASN1PipelineConsumer.
+    """
+
+    def setUp(self):
+        self.threadpool = DummyThreadPool()
+        self.upstream = DummyProducer()
+        self.consumer = DummySink()
+        self.sut = DummyPipelineConsumer(DummyReactor(), self.threadpool)
+        self.sut.MAX_PENDING_CHUNKS = 4
+        self.sut._consumer = self.consumer
+        self.sut.registerProducer(self.upstream)
+
+    def test_order(self):
+        """
+        Results are sent in order, even when the stages are done in
+        a different order.
+        """
+        for chunk in [b'a', b'b', b'c']:
+            self.sut._chunkReceived(chunk)
+
+        # Always run the latest queued call first.
+        self.threadpool.runAll(index=-1)
+
+        self.assertEqual([b'A', b'B', b'C'], self.sut.processed)
+        self.assertEqual([], self.upstream.calls)
+
+    def test_backpressure(self):
+        """
+        The producer is paused at MAX_PENDING_CHUNKS and resumed once
+        half of them are processed.
+        """
+        for chunk in [b'a', b'b', b'c']:
+            self.sut._chunkReceived(chunk)
+        self.assertEqual([], self.upstream.calls)
+
+        self.sut._chunkReceived(b'd')
+        self.assertEqual(['pause'], self.upstream.calls)
+
+        # Each chunk goes through 2 stages.
+        self.threadpool.run()
+        self.threadpool.run()
+        self.assertEqual([b'A'], self.sut.processed)
+        self.assertEqual(['pause'], self.upstream.calls)
+
+        self.threadpool.run()
+        self.threadpool.run()
+        self.assertEqual([b'A', b'B'], self.sut.processed)
+        self.assertEqual(['pause', 'resume'], self.upstream.calls)
+
+        self.threadpool.runAll()
+        self.assertEqual(['pause', 'resume'], self.upstream.calls)
+
+    def test_unregisterProducer(self):
+        """
+        Finalization is delayed until all chunks are processed, while the
+        producer is no longer used.
+        """
+        for chunk in [b'a', b'b', b'c', b'd']:
+            self.sut._chunkReceived(chunk)
+
+        self.sut.unregisterProducer()
+
+        self.assertEqual([], self.consumer.chunks)
+        self.assertFalse(self.consumer.unregistered)
+
+        self.threadpool.runAll()
+
+        self.assertEqual([b'A', b'B', b'C', b'D'], self.sut.processed)
+        self.assertEqual([b'end'], self.consumer.chunks)
+        self.assertTrue(self.consumer.unregistered)
+        self.assertEqual(['pause'], self.upstream.calls)
+
+    def test_unregisterProducer_drained(self):
+        """
+        Finalization is done right away when no chunks are pending.
+        """
+        self.sut.unregisterProducer()
+
+        self.assertEqual([b'end'], self.consumer.chunks)
+        self.assertTrue(self.consumer.unregistered)
+
+    def test_stage_failed_after_unregisterProducer(self):
+        """
+        When a stage fails after the producer was unregistered, the
+        consumer is released without being finalized.
+        """
+        self.sut._chunkReceived(b'a')
+        self.sut._chunkReceived(b'bad')
+        self.sut.unregisterProducer()
+
+        self.threadpool.runAll()
+
+        self.assertEqual(1, len(self.sut.failures))
+        self.assertEqual([b'A'], self.sut.processed)
+        self.assertEqual([], self.consumer.chunks)
+        self.assertTrue(self.consumer.unregistered)
+        self.assertIsNone(self.sut._consumer)
+        self.assertEqual([], self.upstream.calls)
+
+    def test_stage_failed(self):
+        """
+        When a stage fails, the producer is stopped and the chunks which
+        are in progress are dropped.
+        """
+        self.sut._chunkReceived(b'bad')
+        self.sut._chunkReceived(b'next')
+        self.sut._chunkReceived(b'other')
+        self.threadpool.run()
+        # Last stage fails for the first chunk, while the second chunk
+        # is in the first stage.
+        self.threadpool.run()
+
+        self.assertEqual(['stop'], self.upstream.calls)
+        self.assertEqual(1, len(self.sut.failures))
+        self.sut.failures[0].trap(ValueError)
+
+        # The chunk in progress is not sent to the next stage.
+        self.threadpool.run()
+        self.assertEqual([], self.threadpool.calls)
+
+        self.sut._chunkReceived(b'more')
+        self.assertEqual([], self.threadpool.calls)
+        self.assertEqual([], self.sut.processed)
+
+    def test_chunkProcessed_failed(self):
+        """
+        An error raised while handling the result stops the producer and
+        the next chunks are no longer processed.
+        """
+        self.sut._chunkReceived(b'fail')
+        self.sut._chunkReceived(b'next')
+
+        self.threadpool.runAll()
+
+        self.assertEqual(['stop'], self.upstream.calls)
+        self.assertEqual(1, len(self.sut.failures))
+        self.assertEqual([], self.sut.processed)
+        self.assertEqual([], self.threadpool.calls)
+
+    def test_no_stages(self):
+        """
+        Without stages, chunks are processed right away.
+        """
+        self.sut._stages = []
+
+        self.sut._chunkReceived(b'a')
+
+        self.assertEqual([b'a'], self.sut.processed)
+        self.assertEqual([], self.threadpool.calls)
+
+    def test_stages_not_defined(self):
+        """
+        An error is raised when the stages are not defined.
+        """
+        self.sut._stages = None
+
+        self.assertRaises(
+            NotImplementedError,
+            self.sut._chunkReceived, b'a'
+            )
@@ -1,6 +1,12 @@
 from __future__ import unicode_literals
+import os
+from collections import deque
+
 import asn1stream as asn1
-from twisted.internet.interfaces import IConsumer
+from twisted.internet.interfaces import IConsumer, IPushProducer
+from twisted.internet.threads import deferToThreadPool
+from twisted.python import log
+from twisted.python.failure import Failure
 from zope.interface import implementer
 
 
@@ -141,6 +147,551 @@ class ASN1StreamConsumer(object):
         return tag
 
 
+@implementer(IPushProducer)
+class _TeeSinkProducer(object):
+    """
+    Producer registered with a single sink of an ASN1StreamTee.
+
+    It reports back to the tee when its sink is saturated.
+    """
+
+    def __init__(self, tee, sink):
+        self._tee = tee
+        self.sink = sink
+
+    def pauseProducing(self):
+        """
+        Called by the sink when it can't receive more data.
+        """
+        self._tee._sinkPaused(self)
+
+    def resumeProducing(self):
+        """
+        Called by the sink when it can receive more data.
+        """
+        self._tee._sinkResumed(self)
+
+    def stopProducing(self):
+        """
+        Called by the sink when it will no longer receive data.
+        """
+        self._tee._sinkStopped(self)
+
+
+class ASN1StreamTee(ASN1StreamConsumer):
+    """
+    Send the chunks of the large tag to multiple sinks.
+
+    The same chunk object is written to each sink, without copying it.
+    A sink is any IConsumer and it should not modify the received data.
+
+    Each sink applies its own backpressure using the producer registered
+    with it. The upstream producer is paused while at least one sink
+    is saturated and is resumed once all the sinks can receive more data.
+
+    A sink failing to write a chunk is logged and dropped, as if it was
+    stopped, while the other sinks continue to receive the chunks.
+    """
+
+    def __init__(self):
+        super(ASN1StreamTee, self).__init__()
+        # Producers registered with each sink, in the order of the sinks.
+        self._sinks = []
+        # Producers of the sinks which are currently saturated.
+        self._paused_sinks = set()
+
+    def addSink(self, sink):
+        """
+        Register a new IConsumer which will receive the chunks.
+        """
+        producer = _TeeSinkProducer(self, sink)
+        self._sinks.append(producer)
+        sink.registerProducer(producer, True)
+
+    def _chunkReceived(self, data):
+        """
+        Called when tag value is consumed.
+        """
+        for producer in self._sinks[:]:
+            if producer not in self._sinks:
+                # Stopped while the chunk was written to a previous sink.
+                continue
+            try:
+                producer.sink.write(data)
+            except Exception:
+                log.err(None, 'Failed to write to sink.')
+                self._sinkStopped(producer)
+
+    def registerProducer(self, producer):
+        """
+        Signal that we are receiving data from a streamed request.
+
+        The producer is paused right away if a sink is already saturated.
+        """
+        super(ASN1StreamTee, self).registerProducer(producer)
+        if self._paused_sinks:
+            self._producer.pauseProducing()
+
+    def unregisterProducer(self):
+        """
+        Called when all data was received.
+        """
+        self._producer = None
+        self._paused_sinks = set()
+        sinks, self._sinks = self._sinks, []
+        for producer in sinks:
+            producer.sink.unregisterProducer()
+
+    def _sinkPaused(self, producer):
+        """
+        Called when a sink is saturated.
+        """
+        if producer in self._paused_sinks:
+            return
+
+        self._paused_sinks.add(producer)
+        if len(self._paused_sinks) == 1 and self._producer:
+            self._producer.pauseProducing()
+
+    def _sinkResumed(self, producer):
+        """
+        Called when a sink can receive more data.
+        """
+        if producer not in self._paused_sinks:
+            return
+
+        self._paused_sinks.remove(producer)
+        if not self._paused_sinks and self._producer:
+            self._producer.resumeProducing()
+
+    def _sinkStopped(self, producer):
+        """
+        Called when a sink will no longer receive data.
+
+        Upstream is stopped once there are no more sinks.
+        """
+        if producer not in self._sinks:
+            return
+
+        self._sinks.remove(producer)
+        self._sinkResumed(producer)
+
+        if not self._sinks and self._producer:
+            self._producer.stopProducing()
+
+
+@implementer(IConsumer)
+class ASN1FileSink(object):
+    """
+    Write the chunks of the large tag to a file.
+
+    Chunks are collected and written in batches using a single `writev`
+    call, once `batch_size` bytes are pending or after `max_latency`
+    seconds since the first pending chunk.
+
+    The file is synced to disk once, when the producer is unregistered at
+    the end of the message.
+
+    When a write fails, the file is closed and the error is raised for
+    all the following calls to `write` and `unregisterProducer`.
+    """
+    # Pending bytes which trigger a write.
+    DEFAULT_BATCH_SIZE = 256 * 1024
+    # Maximum number of buffers passed to a single writev call.
+    # This is IOV_MAX on Linux and BSD.
+    MAX_IOV = 1024
+
+    def __init__(
+            self, path, batch_size=DEFAULT_BATCH_SIZE, max_latency=None,
+            clock=None):
+        self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        self._batch_size = batch_size
+        self._max_latency = max_latency
+        if max_latency is not None and clock is None:
+            from twisted.internet import reactor as clock
+        self._clock = clock
+        self._producer = None
+        # Chunks not yet written to disk.
+        self._pending = []
+        self._pending_size = 0
+        # Delayed call used to write pending chunks after max_latency.
+        self._delayed_write = None
+        # Error raised by a previous write.
+        self._error = None
+
+    def preallocate(self, length):
+        """
+        Reserve disk space for a tag with a definite `length`.
+
+        Call it with the `Tag.length` of the large tag, before writing
+        its chunks.
+
+        Does nothing for tags of unknown length or when the OS doesn't
+        support it.
+        """
+        if not length or not hasattr(os, 'posix_fallocate'):
+            return
+        try:
+            os.posix_fallocate(self._fd, 0, length)
+        except OSError:
+            # Preallocation is just an optimization.
+            pass
+
+    def registerProducer(self, producer, streaming):
+        """
+        Writes are synchronous, so the producer is never paused.
+        """
+        self._producer = producer
+
+    def unregisterProducer(self):
+        """
+        Called at the end of the message.
+
+        Write all pending data, sync it to disk and close the file.
+        """
+        self._producer = None
+        if self._error is not None:
+            self.close()
+            raise self._error
+
+        if self._fd is None:
+            return
+
+        try:
+            self._flush()
+            # Only keep the used size when a larger size was preallocated.
+            os.ftruncate(self._fd, os.lseek(self._fd, 0, os.SEEK_CUR))
+            os.fsync(self._fd)
+        finally:
+            self.close()
+
+    def close(self):
+        """
+        Close the file without writing the pending data.
+
+        Call it when the message was aborted or has failed.
+        """
+        self._producer = None
+        self._pending = []
+        self._pending_size = 0
+        if self._delayed_write:
+            if self._delayed_write.active():
+                self._delayed_write.cancel()
+            self._delayed_write = None
+
+        if self._fd is None:
+            return
+        os.close(self._fd)
+        self._fd = None
+
+    def write(self, data):
+        """
+        Called for each chunk of the tag value.
+        """
+        if self._error is not None:
+            raise self._error
+
+        if not data or self._fd is None:
+            return
+
+        self._pending.append(data)
+        self._pending_size += len(data)
+
+        if self._pending_size >= self._batch_size:
+            self._flush()
+            return
+
+        if self._max_latency is not None and not self._delayed_write:
+            self._delayed_write = self._clock.callLater(
+                self._max_latency, self._flush)
+
+    def _flush(self):
+        """
+        Write all pending chunks to the file.
+        """
+        if self._delayed_write:
+            if self._delayed_write.active():
+                self._delayed_write.cancel()
+            self._delayed_write = None
+
+        if self._fd is None:
+            return
+
+        pending = self._pending
+        self._pending = []
+        self._pending_size = 0
+
+        while pending:
+            batch = pending[:self.MAX_IOV]
+            try:
+                written = self._writev(batch)
+            except OSError as error:
+                # The file is no longer complete.
+                self._error = error
+                self.close()
+                raise
+            # Drop the written chunks and keep what was left from a
+            # partial write.
+            for index, chunk in enumerate(batch):
+                if written < len(chunk):
+                    pending = pending[index:]
+                    pending[0] = memoryview(chunk)[written:]
+                    break
+                written -= len(chunk)
+            else:
+                pending = pending[len(batch):]
+
+    def _writev(self, buffers):
+        """
+        Write the buffers and return the number of written bytes.
+        """
+        if hasattr(os, 'writev'):
+            return os.writev(self._fd, buffers)
+        # Python 2 can't join memoryview objects.
+        return os.write(self._fd, b''.join(
+            buffer.tobytes() if isinstance(buffer, memoryview) else buffer
+            for buffer in buffers))
+
+
+class _PipelineStage(object):
+    """
+    Run a CPU heavy function for each chunk, in a thread pool.
+
+    A stage processes a single chunk at a time, so that chunks are
+    processed and returned in order, even for stateful functions like
+    decompression or hashing.
+    Different stages and different streams run in parallel.
+    """
+
+    def __init__(self, function, reactor, threadpool, done, failed):
+        self._function = function
+        self._reactor = reactor
+        self._threadpool = threadpool
+        # Called in the reactor thread with the result of each chunk.
+        self._done = done
+        self._failed = failed
+        self._pending = deque()
+        self._busy = False
+        self._stopped = False
+
+    def put(self, data):
+        """
+        Queue a new chunk for processing.
+        """
+        if self._stopped:
+            return
+        self._pending.append(data)
+        self._run()
+
+    def stop(self):
+        """
+        Drop all the chunks which are not yet processed, including the
+        result of the chunk which is currently processed.
+        """
+        self._stopped = True
+        self._pending.clear()
+
+    def _run(self):
+        """
+        Start processing the next chunk, if not already busy.
+        """
+        if self._busy or self._stopped or not self._pending:
+            return
+
+        self._busy = True
+        deferred = deferToThreadPool(
+            self._reactor, self._threadpool,
+            self._function, self._pending.popleft())
+        deferred.addCallbacks(self._cbProcessed, self._ebProcessed)
+
+    def _cbProcessed(self, result):
+        """
+        Called in the reactor thread when a chunk was processed.
+        """
+        self._busy = False
+        if self._stopped:
+            return
+
+        try:
+            self._done(result)
+        except Exception:
+            self._failed(Failure())
+        finally:
+            self._run()
+
+    def _ebProcessed(self, failure):
+        """
+        Called in the reactor thread when a chunk failed to be processed.
+        """
+        self._busy = False
+        if self._stopped:
+            return
+
+        self._pending.clear()
+        self._failed(failure)
+
+
+class ASN1PipelineConsumer(ASN1StreamConsumer):
+    """
+    Process the chunks of the large tag in a thread pool.
+
+    The ASN1 structure is parsed in the reactor thread, while each chunk
+    is passed through the `_stages` functions in a thread pool.
+    The result of the last stage is sent in order to
+    `_chunkProcessed`, in the reactor thread.
+
+    The producer is paused while too many chunks are waiting to be
+    processed.
+    """
+    # List of functions called in a thread for each chunk.
+    # Each function receives the result of the previous one.
+    # Should be defined by each subclass.
+    # When empty, chunks are sent directly to `_chunkProcessed`.
+    _stages = None
+
+    # Number of queued chunks for which the producer is paused.
+    MAX_PENDING_CHUNKS = 16
+
+    def __init__(self, reactor=None, threadpool=None):
+        super(ASN1PipelineConsumer, self).__init__()
+        if reactor is None:
+            from twisted.internet import reactor
+        if threadpool is None:
+            threadpool = reactor.getThreadPool()
+        self._reactor = reactor
+        self._threadpool = threadpool
+        self._pipeline = None
+        # Number of chunks not yet passed to _chunkProcessed.
+        self._pending_chunks = 0
+        self._paused = False
+        # Whether the producer was unregistered while chunks were pending.
+        self._unregister_pending = False
+        # Whether a stage has failed and the chunks are no longer processed.
+        self._failed = False
+
+    def _chunkProcessed(self, data):
+        """
+        Called in the reactor thread with the result of the last stage.
+        """
+        raise NotImplementedError('Implement _chunkProcessed.')
+
+    def _pipelineFailed(self, failure):
+        """
+        Called in the reactor thread when a stage has failed.
+
+        Stops the producer and releases the consumer, without finalizing
+        it. Subclasses can extend it to report the failure.
+        """
+        if self._producer:
+            self._producer.stopProducing()
+
+        if self._consumer:
+            self._consumer.unregisterProducer()
+            self._consumer = None
+
+    def _chunkReceived(self, data):
+        """
+        Called when tag value is consumed.
+        """
+        if self._failed:
+            return
+
+        if self._pipeline is None:
+            self._pipeline = self._createPipeline()
+
+        if not self._pipeline:
+            self._chunkProcessed(data)
+            return
+
+        self._pending_chunks += 1
+        if self._pending_chunks >= self.MAX_PENDING_CHUNKS:
+            self._pause()
+
+        self._pipeline[0].put(data)
+
+    def unregisterProducer(self):
+        """
+        Called when all data was received.
+
+        Finalization is delayed until all chunks are processed.
+        """
+        if self._pending_chunks:
+            # The producer is no longer used, only the consumer is
+            # finalized later.
+            self._producer = None
+            self._paused = False
+            self._unregister_pending = True
+            return
+
+        super(ASN1PipelineConsumer, self).unregisterProducer()
+
+    def _createPipeline(self):
+        """
+        Return the stages, linked in order.
+        """
+        if self._stages is None:
+            raise NotImplementedError('Define _stages.')
+
+        pipeline = []
+        done = self._cbPipeline
+        for function in reversed(self._stages):
+            stage = _PipelineStage(
+                function, self._reactor, self._threadpool,
+                done, self._ebPipeline)
+            pipeline.insert(0, stage)
+            done = stage.put
+        return pipeline
+
+    def _cbPipeline(self, data):
+        """
+        Called when a chunk went through all the stages.
+        """
+        if self._failed:
+            return
+
+        self._pending_chunks -= 1
+        self._chunkProcessed(data)
+
+        if self._paused and self._pending_chunks <= (
+                self.MAX_PENDING_CHUNKS // 2):
+            self._resume()
+
+        if self._unregister_pending and not self._pending_chunks:
+            self._unregister_pending = False
+            super(ASN1PipelineConsumer, self).unregisterProducer()
+
+    def _ebPipeline(self, failure):
+        """
+        Called when a chunk failed in one of the stages.
+        """
+        if self._failed:
+            return
+
+        self._failed = True
+        for stage in self._pipeline:
+            stage.stop()
+        self._pending_chunks = 0
+        self._unregister_pending = False
+        self._pipelineFailed(failure)
+
+    def _pause(self):
+        """
+        Stop receiving data until the pipeline is drained.
+        """
+        if self._paused or not self._producer:
+            return
+        self._paused = True
+        self._producer.pauseProducing()
+
+    def _resume(self):
+        """
+        Continue receiving data.
+        """
+        self._paused = False
+        if self._producer:
+            self._producer.resumeProducing()
+
+
 class DumpCompressedCMS(ASN1StreamConsumer):
     """
     Print all the data of the compressed data from cms.ContentInfo sequence.